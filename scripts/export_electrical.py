@@ -30,20 +30,22 @@ import argparse
 import beautifultable
 import functools
 import itertools
-import lxml
+import lxml.etree
 import logging
 import natsort
+import numpy
 import pathlib
 import re
 import sys
 import types
 import typing
-import matplotlib.path
 
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 sys.path.append('/usr/share/inkscape/extensions')
 import inkex
+# Bound once, since these are checked for every object processed
+from inkex.elements import Group, Layer, PathElement, Rectangle, TextElement, Use
 
 # Apply cachingto getElementById, since we need to resolve *all* clones
 # in the document to their originals (to get their bounding boxes to
@@ -54,32 +56,70 @@ import inkex
 inkex.SvgDocumentElement.getElementById = functools.cache(inkex.SvgDocumentElement.getElementById)
 
 
+# Cache composed transforms for the same reason (and with the same
+# caveat): composed_transform() walks up all ancestors and multiplies
+# their transforms on every call, while most objects share their parent
+# with many others.
+@functools.cache
+def _composed_transform(elem):
+    return elem.composed_transform()
+
+
+def composed_parent_transform(obj):
+    """
+    Return the composed transform of the parent of obj, i.e. the
+    transform that maps the coordinates of obj to document coordinates.
+    """
+    return _composed_transform(obj.getparent())
+
+
 # Idea: Symbol superclass with Fixture, EmergencyFixture, WCD, etc. subclasses. Subclasses
 # define class attributes category and label with fixed values, and a
 # list of required and optional fields that the superclass (or the main
 # code) can then use to check for missing or extra fields.
-class Symbol(types.SimpleNamespace):
-    pass
+class Symbol:
+    # Symbols are created for every outlet, fixture, etc., so use slots
+    # rather than a per-instance dict. Subclasses must define an empty
+    # __slots__ to keep it that way.
+    __slots__ = (
+        'floor', 'dist', 'sublayer', 'obj', 'space', 'space_obj', 'contour_dist',
+        'symbol', 'circuit', 'label', 'switch_group', 'global_switch_group', 'pair',
+        'sockets', 'fixture_id', 'fixture', 'power', 'count', 'distbox_label',
+    )
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def attrs(self):
+        """
+        Return a dict of all attributes that are set on this symbol.
+        """
+        return {name: getattr(self, name) for name in Symbol.__slots__ if hasattr(self, name)}
+
+    def __repr__(self):
+        attrs = ', '.join('{}={!r}'.format(name, value) for name, value in self.attrs().items())
+        return '{}({})'.format(type(self).__name__, attrs)
 
 
 class Outlet(Symbol):
     sublayers = ['WCD_etc']
-    pass
+    __slots__ = ()
 
 
 class Fixture(Symbol):
     sublayers = ['Verlichting']
-    pass
+    __slots__ = ()
 
 
 class EmergencyFixture(Symbol):
     sublayers = ['NV']
-    pass
+    __slots__ = ()
 
 
 class JunctionBox(Symbol):
     sublayers = ['Lasdozen']
-    pass
+    __slots__ = ()
 
 
 class FixtureConnection(JunctionBox):
@@ -87,28 +127,28 @@ class FixtureConnection(JunctionBox):
     # outlet layer too (ideally only when combined with an outlet, but
     # that's hard to check...)
     sublayers = ['Lasdozen', 'WCD_etc']
-    pass
+    __slots__ = ()
 
 
 class Connection(Symbol):
     sublayers = ['WCD_etc']
-    pass
+    __slots__ = ()
 
 
 class Switch(Symbol):
     sublayers = ['WCD_etc']
-    pass
+    __slots__ = ()
 
 
 class DistributionCabinet(Symbol):
     # Allow None for the root cabinet
     sublayers = [None, 'Installaties']
-    pass
+    __slots__ = ()
 
 
 class Device(Symbol):
     sublayers = ['Installaties']
-    pass
+    __slots__ = ()
 
 
 class FixtureInfo(typing.NamedTuple):
@@ -166,7 +206,16 @@ CIRCUITS_PER_DIST = {
     'RK1': ['5F1']
 }
 
-LOCAL_SWITCHES = {'a', 'b', 'c', 'd'}
+# Normalize the above into (circuit, label) pairs once, with string
+# circuit names and None for circuits without a predefined label
+CIRCUITS_PER_DIST = {
+    dist: [
+        (str(circuit[0]), circuit[1]) if isinstance(circuit, tuple) else (str(circuit), None)
+        for circuit in circuits
+    ] for (dist, circuits) in CIRCUITS_PER_DIST.items()
+}
+
+LOCAL_SWITCHES = frozenset({'a', 'b', 'c', 'd'})
 
 
 SYMBOLS = {
@@ -290,29 +339,184 @@ SYMBOLS = {
     },
 }
 
+# The class and fixed attributes for each symbol, split once here so
+# this does not need to happen for every symbol processed
+SYMBOL_FACTORIES = {
+    name: (info['class'], {k: v for k, v in info.items() if k != 'class'})
+    for name, info in SYMBOLS.items()
+}
+
+# Symbol attributes set by texts inside a symbol group, by text class
+CLASS_TO_ATTR = {
+    'elektra-groep': 'circuit',
+    'elektra-schakelaar': 'switch_group',
+    'elektra-armatuur': 'fixture_id',
+    'elektra-kast': 'distbox_label',
+    'elektra-label': 'label',
+    'elektra-ruimte': 'space',
+}
+
+
+INKSCAPE_LABEL = '{http://www.inkscape.org/namespaces/inkscape}label'
+LAYER_XPATH = lxml.etree.XPath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS)
 
-def layers(doc, label_re=re.compile(".*")):
+# Layer labels, capturing the floor (and for electrical layers, the
+# distribution box and sublayer)
+CONTOUR_LAYER_RE = re.compile(r'([^_]*).*_ruimtecontouren')
+NUMBER_LAYER_RE = re.compile(r'([^_]*).*_(?:ruimtenummers|buitenlabels)')
+ELEKTRA_LAYER_RE = re.compile(r'(.*)_Elektra_([^_]*)(?:_(.*))?')
+MATCH_ALL_RE = re.compile(r'.*')
+
+# Circuit labels, capturing the dist (if any) and circuit. This regex
+# ended up a bit complex, but needed to support both dot-separated like
+# L01.2 or also L01.K2, but also unseparated like NV1, and I wanted to
+# have only two capture groups for dist and circuit. I'm not sure I
+# understand it exactly, but it works for all cases needed:
+#   c = ['L1.2', 'L1.23', 'L01.2', 'L01.23', 'HKL.2', 'HKL.23', 'HKL.K2',
+#       'NV1', 'NV?', '?', '2', '23', 'NC'])]
+#   [CIRCUIT_RE.match(s).groups() for s in c]
+CIRCUIT_RE = re.compile(r'([A-Z]+|.*(?=\.)|)\.?((?<=\.).*|[0-9?+]+|(?<=^).*)$')
+
+
+# Cached for the same reason as getElementById above, so the document
+# is only scanned for layers once, rather than for every layers() call.
+@functools.cache
+def all_layers(doc):
+    """
+    Return a list of (layer, label) tuples for all layers in the given document.
+    """
+    layers = LAYER_XPATH(doc)
+    return [(layer, layer.attrib[INKSCAPE_LABEL]) for layer in layers]
+
+
+def layers(doc, label_re=MATCH_ALL_RE):
     """
 
     Return all layers in the given document, optionally matching their label against a given regex.
 
     Returns a tuple containing the layer, its full label and any groups captured by the regex.
     """
-    for layer in doc.xpath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS):
-        label_attr = '{http://www.inkscape.org/namespaces/inkscape}label'
-        label = layer.attrib[label_attr]
-        m = re.match(label_re, label)
+    for (layer, label) in all_layers(doc):
+        m = label_re.match(label)
         if m:
             yield (layer, label) + m.groups()
 
 
+# Cached since the bounding boxes of warned objects are often already
+# calculated to find the space or dist contour they are in (and because
+# multiple warnings are often emitted for the same object). Note that
+# the returned box should not be modified.
+@functools.cache
+def bounding_box(obj):
+    """
+    Return the bounding box of obj in document coordinates.
+    """
+    return obj.bounding_box(composed_parent_transform(obj))
+
+
+# Path data with only absolute moveto, lineto and closepath commands,
+# which is what simple polygons like room contours usually look like
+SIMPLE_PATH_RE = re.compile(r'^[MLZz\s\d.,eE+-]*$')
+PATH_NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def path_points(d):
+    """
+    Return the (untransformed) points of the given SVG path data as an
+    (N, 2) numpy array.
+
+    Simple polygons are parsed using a regex directly, anything else
+    (relative commands, curves, etc.) is parsed by inkex.
+    """
+    if SIMPLE_PATH_RE.match(d):
+        coords = numpy.array(PATH_NUMBER_RE.findall(d), dtype=float)
+        if len(coords) % 2 == 0:
+            return coords.reshape(-1, 2)
+
+    return numpy.array([(p.x, p.y) for p in inkex.paths.Path(d).control_points])
+
+
+def polygon_contains(polygon, points):
+    """
+    Return a boolean array that tells for each of the given points
+    (an (M, 2) array) whether it lies inside the polygon (an (N, 2)
+    array of vertices).
+
+    This uses the even-odd rule: a point is inside when a ray from it
+    crosses the polygon edges an odd number of times.
+    """
+    (x1, y1) = polygon.T
+    (x2, y2) = numpy.roll(polygon, -1, axis=0).T
+    # Compare every point (rows) against every edge (columns)
+    px = points[:, 0, numpy.newaxis]
+    py = points[:, 1, numpy.newaxis]
+    crosses = (y1 > py) != (y2 > py)
+    # Horizontal edges give a division by zero, but never cross anyway
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+    return numpy.count_nonzero(crosses & (px < x_cross), axis=1) % 2 == 1
+
+
 def layer_for_obj(obj):
-    for parent in obj.ancestors():
-        if isinstance(parent, inkex.Layer):
+    for parent in obj.iterancestors():
+        if isinstance(parent, Layer):
             return parent
     return None
 
 
+# Natural sort key for space numbers and the like. Cached since the
+# same strings are sorted over and over again for every circuit.
+natsort_key = functools.cache(natsort.natsort_keygen())
+
+
+def natsorted_items(d):
+    """
+    Return the items of the given dict, naturally sorted by key.
+    """
+    return sorted(d.items(), key=lambda item: natsort_key(item[0]))
+
+
+# Cached since multiple warnings are often emitted for the same object
+@functools.cache
+def ancestor_info(obj):
+    """
+    Return a (layer, top_obj, top_layer) tuple for the given object,
+    containing the first layer that contains the object, the child of
+    that layer that contains the object, and the toplevel element (child
+    of the root element) that contains the object.
+    """
+    child = obj
+    top_obj = None
+    top_layer = None
+    layer = None
+    for parent in obj.iterancestors():
+        # Found first layer
+        if layer is None and isinstance(parent, Layer):
+            top_obj = child
+            layer = parent
+
+        # When the loop ends, parent is the root svg element
+        top_layer = child
+        child = parent
+
+    return (layer, top_obj, top_layer)
+
+
+class LazyStr:
+    """
+    Calls func(*args) only when converted to a string, so log messages
+    passed as arguments are only formatted when actually emitted.
+    """
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
 class ErrorCollector:
     outer_rect_style = 'stroke:#ff0000;stroke-width:3;fill:none'
     inner_rect_style = 'stroke:#ff0000;stroke-width:3;stroke-dasharray:6,3;fill:none'
@@ -323,46 +527,57 @@ class ErrorCollector:
     def __init__(self, logger=None):
         self.logger = logger
         self.warnings = defaultdict(lambda: defaultdict(lambda: []))
+        # Warnings to log once the space they are in is known
+        self.unresolved_logs = []
 
     def warn(self, obj, msg, *args, sym_attrs=None):
         if isinstance(obj, Symbol):
-            sym_attrs = obj.__dict__
+            sym_attrs = obj.attrs()
             obj = obj.obj
 
-        child = obj
-        top_obj = None
-        top_layer = None
-        layer = None
-        for parent in child.ancestors():
-            # Found first layer
-            if layer is None and isinstance(parent, inkex.Layer):
-                top_obj = child
-                layer = parent
-
-            # found root svg element
-            if parent.getparent() is None:
-                top_layer = child
+        (layer, top_obj, top_layer) = ancestor_info(obj)
 
-            child = parent
-
-        self.warnings[top_layer][(layer, top_obj)].append((obj, msg.format(*args)))
+        # The message is only formatted when it is written to the
+        # document or log, since most warnings are never shown
+        self.warnings[top_layer][(layer, top_obj)].append((obj, msg, args))
 
         if self.logger:
-            space = sym_attrs.get('space', None) if sym_attrs else None
-            if space:
-                where = "{} ({})".format(layer.label, space)
+            sym_attrs = sym_attrs or {}
+            space_obj = sym_attrs.get('space_obj', None)
+            if space_obj is not None and 'space' not in sym_attrs:
+                # Spaces are looked up in bulk after processing all
+                # layers, so log this once the space is known (see
+                # log_unresolved)
+                self.unresolved_logs.append((layer, top_obj, obj, msg, args, space_obj))
             else:
-                where = layer.label
-
-            self.logger.warning(("{}: {} -> {}: " + msg).format(where, top_obj.get_id(), obj.get_id(), *args))
+                self.log(layer, top_obj, obj, msg, args, sym_attrs.get('space', None))
 
-            if isinstance(obj, inkex.elements.TextElement):
-                extra = "Text: " + obj.get_text()
-            elif isinstance(obj, inkex.elements.Use):
-                extra = "Clone of: " + obj.get('xlink:href')
-            else:
-                extra = lxml.etree.tostring(obj)
-            self.logger.warning(extra)
+    def log(self, layer, top_obj, obj, msg, args, space):
+        if space:
+            where = "{} ({})".format(layer.label, space)
+        else:
+            where = layer.label
+
+        self.logger.warning("%s: %s -> %s: %s", where, top_obj.get_id(), obj.get_id(),
+                            LazyStr(msg.format, *args))
+        self.logger.warning("%s", LazyStr(self.describe, obj))
+
+    def log_unresolved(self, spaces):
+        """
+        Log the warnings that were waiting for their space to be looked
+        up, given a dict of space numbers by space object.
+        """
+        for (layer, top_obj, obj, msg, args, space_obj) in self.unresolved_logs:
+            self.log(layer, top_obj, obj, msg, args, spaces.get(space_obj, None))
+        self.unresolved_logs.clear()
+
+    def describe(self, obj):
+        if isinstance(obj, TextElement):
+            return "Text: " + obj.get_text()
+        elif isinstance(obj, Use):
+            return "Clone of: " + obj.get('xlink:href')
+        else:
+            return lxml.etree.tostring(obj)
 
     def bb_to_rect(self, bb, **attrs):
         return inkex.Rectangle.new(
@@ -377,22 +592,24 @@ class ErrorCollector:
             output_layer = inkex.Layer("{}_Warnings".format(top_layer.label))
             top_layer.append(output_layer)
             for (layer, top_obj), warnings in per_top_layer.items():
-                top_bb = top_obj.bounding_box(top_obj.getparent().composed_transform())
-                boxes_with_texts = [(top_bb, self.outer_rect_style, layer.label)]
-
+                top_bb = bounding_box(top_obj)
                 if not top_bb:
                     self.logger.warning("{}: {} -> {}: No bounding box, cannot mark warning in output document".format(
                         layer.label, top_obj.get_id(), top_obj.get_id()
                     ))
                     continue
 
-                for obj, msg in warnings:
-                    if isinstance(obj, inkex.TextElement):
+                # Copy the (cached) bounding box, since it is stretched below
+                top_bb = inkex.BoundingBox(top_bb)
+                boxes_with_texts = [(top_bb, self.outer_rect_style, layer.label)]
+
+                for obj, msg, args in warnings:
+                    if isinstance(obj, TextElement):
                         # inkex cannot calculate a proper bounding box for
                         # text, but has shape_box() that gives a
                         # (potentially zero-size) box around all anchor
                         # points.
-                        shape = obj.shape_box(obj.getparent().composed_transform())
+                        shape = obj.shape_box(composed_parent_transform(obj))
                         m = self.text_box_margin
                         obj_bb = inkex.BoundingBox(
                             x=(shape.x.minimum - m, shape.x.maximum + m),
@@ -401,9 +618,10 @@ class ErrorCollector:
                         # Stretch top_bb to include this new fake bb
                         top_bb += obj_bb
                     else:
-                        obj_bb = obj.bounding_box(obj.getparent().composed_transform())
+                        obj_bb = bounding_box(obj)
 
-                    boxes_with_texts.append((obj_bb, self.inner_rect_style, "  {}: {}".format(obj.get_id(), msg)))
+                    boxes_with_texts.append((obj_bb, self.inner_rect_style,
+                                             "  {}: {}".format(obj.get_id(), msg.format(*args))))
 
                 x = top_bb.left
                 y = top_bb.bottom
@@ -426,43 +644,90 @@ class ContourTracker:
     def __init__(self, errors):
         self.errors = errors
         self.contours = defaultdict(lambda: [])
+        # Per floor, an (N, 4) array with the bounding boxes of all
+        # contours, built on the first lookup (see contour_bboxes)
+        self.bbox_index = {}
+        # Lookup results by (floor, obj), cleared when contours change
+        self.contour_cache = {}
 
     def find_spaces(self, doc):
-        contour_re = re.compile(r'([^_]*).*_ruimtecontouren')
-        for (layer, label, floor) in layers(doc, contour_re):
+        for (layer, label, floor) in layers(doc, CONTOUR_LAYER_RE):
             self.process_contour_layer(layer, floor)
 
-        number_re = re.compile(r'([^_]*).*_(?:ruimtenummers|buitenlabels)')
-        for (layer, label, floor) in layers(doc, number_re):
+        for (layer, label, floor) in layers(doc, NUMBER_LAYER_RE):
             self.process_number_layer(layer, floor)
 
+    def process_contour_layer(self, layer, floor):
+        for obj in layer:
+            self.add_contour(floor, obj)
+
+    def process_number_layer(self, layer, floor):
+        for obj in layer:
+            if isinstance(obj, TextElement):
+                number = obj.get_text(sep=" ")
+                contour = self.find_contour(floor, obj)
+                if contour:
+                    if hasattr(contour, 'number') and contour.number != number:
+                        self.errors.warn(obj, "Duplicate space number ({} and {})".format(contour.number, number))
+                    else:
+                        contour.number = number
+            else:
+                self.errors.warn(obj, "Unknown object in space number layer")
+
     def add_contour(self, floor, obj, **kwargs):
-        path_string = None
-        if isinstance(obj, inkex.elements.PathElement):
-            path_string = obj.attrib['d']
-        elif isinstance(obj, inkex.elements.Rectangle):
-            path_string = obj.get_path()
+        if isinstance(obj, PathElement):
+            points = path_points(obj.attrib['d'])
+        elif isinstance(obj, Rectangle):
+            left, top, right, bottom = obj.left, obj.top, obj.right, obj.bottom
+            points = numpy.array([(left, top), (right, top), (right, bottom), (left, bottom)])
         else:
             self.errors.warn(obj, "Unknown contour object")
             return
 
-        path = inkex.paths.Path(path_string)
-        transform = obj.composed_transform()
+        transform = composed_parent_transform(obj) @ obj.transform
         if transform:
-            path.transform(transform, inplace=True)
-
-        polygon = matplotlib.path.Path([(p.x, p.y) for p in path.control_points])
-
-        self.contours[floor].append(self.Contour(polygon=polygon, obj=obj, **kwargs))
+            ((a, c, e), (b, d, f)) = transform.matrix
+            points = points @ numpy.array([(a, b), (c, d)]) + (e, f)
+
+        # Bounding box of the polygon, to cheaply skip the full
+        # polygon_contains test for points nowhere near it
+        bbox = (*points.min(axis=0), *points.max(axis=0))
+
+        self.contours[floor].append(self.Contour(polygon=points, bbox=bbox, obj=obj, **kwargs))
+        self.bbox_index.pop(floor, None)
+        self.contour_cache.clear()
+
+    def contour_bboxes(self, floor):
+        """
+        Return an (N, 4) array with the (xmin, ymin, xmax, ymax)
+        bounding boxes of all contours on the given floor, in the same
+        order as self.contours[floor].
+        """
+        bboxes = self.bbox_index.get(floor, None)
+        if bboxes is None:
+            bboxes = numpy.array([contour.bbox for contour in self.contours[floor]]).reshape(-1, 4)
+            self.bbox_index[floor] = bboxes
+        return bboxes
 
     def find_contour(self, floor, obj):
-        bbox = obj.bounding_box(obj.getparent().composed_transform())
+        key = (floor, obj)
+        if key not in self.contour_cache:
+            self.contour_cache[key] = self._find_contour(floor, obj)
+        return self.contour_cache[key]
+
+    def _find_contour(self, floor, obj):
+        bbox = bounding_box(obj)
         if bbox is None:
             self.errors.warn(obj, "Object without bounding box?")
             return None
-        center = bbox.center
-        for contour in self.contours[floor]:
-            if contour.polygon.contains_points([(center.x, center.y)]):
+        x, y = bbox.center
+        # Check the bounding boxes of all contours at once, and only do
+        # the full polygon_contains test for the contours that remain
+        bboxes = self.contour_bboxes(floor)
+        candidates = (bboxes[:, 0] <= x) & (bboxes[:, 2] >= x) & (bboxes[:, 1] <= y) & (bboxes[:, 3] >= y)
+        for i in numpy.flatnonzero(candidates):
+            contour = self.contours[floor][i]
+            if polygon_contains(contour.polygon, numpy.array([(x, y)]))[0]:
                 return contour
         return None
 
@@ -473,47 +738,68 @@ class SpaceNumbers(ContourTracker):
         self.find_spaces(doc)
 
     def find_spaces(self, doc):
-        contour_re = re.compile(r'([^_]*).*_ruimtecontouren')
-        for (layer, label, floor) in layers(doc, contour_re):
-            self.process_contour_layer(layer, floor)
-
-        number_re = re.compile(r'([^_]*).*_(?:ruimtenummers|buitenlabels)')
-        for (layer, label, floor) in layers(doc, number_re):
-            self.process_number_layer(layer, floor)
+        super().find_spaces(doc)
 
-        for contour in itertools.chain(*self.contours.values()):
+        for contour in itertools.chain.from_iterable(self.contours.values()):
             if not hasattr(contour, 'number'):
                 self.errors.warn(contour.obj, 'Contour without number')
                 contour.number = None
 
-    def process_contour_layer(self, layer, floor):
-        for obj in layer:
-            self.add_contour(floor, obj)
-
-    def process_number_layer(self, layer, floor):
-        for obj in layer:
-            if isinstance(obj, inkex.elements.TextElement):
-                number = obj.get_text(sep=" ")
-                contour = self.find_contour(floor, obj)
-                if contour:
-                    if hasattr(contour, 'number') and contour.number != number:
-                        self.errors.warn(obj, "Duplicate space number ({} and {})".format(contour.number, number))
-                    else:
-                        contour.number = number
-            else:
-                self.errors.warn(obj, "Unknown object in space number layer")
-
     def find_space(self, floor, obj):
         contour = self.find_contour(floor, obj)
         if contour:
             return contour.number
         return None
 
+    def resolve_spaces_bulk(self, floor, objs):
+        """
+        Find the space numbers for a list of objects on the same floor.
+
+        This gives the same result as calling find_space for every
+        object, but tests the centers of all objects against each
+        contour in a single polygon_contains call.
+
+        Returns a list with the space number (or None) for each object.
+        """
+        spaces = [None] * len(objs)
+        indices = []
+        centers = []
+        for i, obj in enumerate(objs):
+            bbox = bounding_box(obj)
+            if bbox is None:
+                self.errors.warn(obj, "Object without bounding box?")
+                continue
+            indices.append(i)
+            centers.append((bbox.center.x, bbox.center.y))
+
+        if not centers:
+            return spaces
+
+        indices = numpy.array(indices)
+        centers = numpy.array(centers)
+        (xs, ys) = centers.T
+        # Like find_contour, the first contour that contains a point wins
+        unresolved = numpy.ones(len(centers), dtype=bool)
+        for contour in self.contours[floor]:
+            (xmin, ymin, xmax, ymax) = contour.bbox
+            inside = unresolved & (xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)
+            if not inside.any():
+                continue
+            inside[inside] = polygon_contains(contour.polygon, centers[inside])
+            for i in indices[inside]:
+                spaces[i] = contour.number
+            unresolved &= ~inside
+            if not unresolved.any():
+                break
+
+        return spaces
+
 
 class ProcessElektra(inkex.EffectExtension):
     def __init__(self):
         super().__init__()
         self.symbols = []
+        self.pending_spaces = defaultdict(lambda: [])
         self.errors = ErrorCollector(logger=logging)
 
         self.arg_parser.add_argument("--mark-questions", action="store_true",
@@ -522,6 +808,9 @@ class ProcessElektra(inkex.EffectExtension):
         self.arg_parser.add_argument("--write-tables", type=str,
                                      help="Write CSV tables to the given directory")
 
+        self.arg_parser.add_argument("--verbose", action="store_true",
+                                     help="Also log symbols that are ignored in the circuit tables")
+
         # Hide default inkscape options that we do not need
         for action in self.arg_parser._actions:
             if action.dest in ['selected_nodes', 'id']:
@@ -530,29 +819,32 @@ class ProcessElektra(inkex.EffectExtension):
                 action.help = "Output filename for saving flooplan with warnings marked (if any)"
 
     def effect(self):
+        if self.options.verbose:
+            logging.basicConfig(level=logging.DEBUG)
+
         doc = self.document
         self.space_numbers = SpaceNumbers(self.errors, doc)
         self.dist_contours = ContourTracker(self.errors)
 
-        label_re = re.compile(r'(.*)_Elektra_([^_]*)(?:_(.*))?')
-        for (layer, label, floor, dist, sublayer) in layers(doc, label_re):
+        for (layer, label, floor, dist, sublayer) in layers(doc, ELEKTRA_LAYER_RE):
             if sublayer == 'Leidingen':
                 continue
             self.process_layer(layer, floor=floor, dist=dist, sublayer=sublayer)
 
-        circuits = list(self.circuit_tables())
+        self.resolve_spaces()
+
+        if self.options.write_tables:
+            dirname = pathlib.Path(self.options.write_tables) / 'circuits'
+            dirname.mkdir(parents=True, exist_ok=True)
 
         # print(self.component_table())
         print(self.switches_table())
-        for dist, table in circuits:
+        for dist, table in self.circuit_tables():
             print()
             print(repr(dist))
             print(table)
 
-        if self.options.write_tables:
-            for dist, table in circuits:
-                dirname = pathlib.Path(self.options.write_tables) / 'circuits'
-                dirname.mkdir(parents=True, exist_ok=True)
+            if self.options.write_tables:
                 fname = dirname / f'{dist}.csv'
                 table.to_csv(str(fname))
 
@@ -569,35 +861,72 @@ class ProcessElektra(inkex.EffectExtension):
 
         return False
 
+    def resolve_spaces(self):
+        """
+        Look up the spaces for all objects collected by process_obj and
+        fill them into the symbols found inside those objects.
+        """
+        spaces = {}
+        for floor, pending in self.pending_spaces.items():
+            objs = [obj for (obj, kwargs) in pending]
+            for (obj, kwargs), space in zip(pending, self.space_numbers.resolve_spaces_bulk(floor, objs)):
+                if space is None:
+                    self.errors.warn(obj, "Not inside any space", sym_attrs=kwargs)
+                spaces[obj] = space
+        self.errors.log_unresolved(spaces)
+
+        for symbol in self.symbols:
+            space_obj = getattr(symbol, 'space_obj', None)
+            if space_obj is not None:
+                del symbol.space_obj
+                # An explicit space label wins over the looked up one
+                if not hasattr(symbol, 'space'):
+                    symbol.space = spaces[space_obj]
+
+            # Local switch groups are only unique within their space, so
+            # these can only be made global now that the space is known
+            switch_group = getattr(symbol, 'global_switch_group', None)
+            if switch_group in LOCAL_SWITCHES:
+                symbol.global_switch_group = '{}-{}'.format(symbol.space, switch_group)
+
     def component_table(self):
-        counts = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: 0)))
+        counts = Counter()
         for symbol in self.symbols:
             if hasattr(symbol, 'circuit'):
-                counts[symbol.dist][symbol.circuit][symbol.symbol] += 1
+                counts[symbol.dist, symbol.circuit, symbol.symbol] += 1
 
         table = beautifultable.BeautifulTable()
         table.set_style(beautifultable.BeautifulTable.STYLE_DOTTED)
         table.columns.header = ["Kast", "Groep", "Symbool", "Aantal"]
         table.columns.alignment["Symbool"] = beautifultable.BeautifulTable.ALIGN_RIGHT
-        for dist, percircuit in counts.items():
-            for circuit, persymbol in percircuit.items():
-                for symbol, count in persymbol.items():
-                    table.rows.append([dist, circuit, symbol, count])
-                    dist = ""
-                    circuit = ""
+        prev_dist, prev_circuit = None, None
+        for (dist, circuit, symbol), count in sorted(counts.items()):
+            # Only show the dist and circuit on their first row
+            table.rows.append([
+                dist if dist != prev_dist else "",
+                circuit if (dist, circuit) != (prev_dist, prev_circuit) else "",
+                symbol,
+                count,
+            ])
+            prev_dist, prev_circuit = dist, circuit
 
         return table
 
     def group_by(self, it, attr, default=None):
-        def key(v):
-            return getattr(v, attr, default)
         # Filter out things without that attribute by default (since
         # comparing strings with None in sorted is impossible), but
         # still allow e.g. the empty string (or some other comparable
         # value) to return those values anyway.
-        if default is None:
-            it = (v for v in it if hasattr(v, attr))
-        return itertools.groupby(sorted(it, key=key), key=key)
+        groups = defaultdict(lambda: [])
+        for v in it:
+            if hasattr(v, attr):
+                groups[getattr(v, attr)].append(v)
+            elif default is not None:
+                groups[default].append(v)
+
+        # Only sort the groups, values keep their original order within
+        # each group
+        return sorted(groups.items(), key=lambda item: item[0])
 
     def circuit_tables(self):
 
@@ -611,16 +940,15 @@ class ProcessElektra(inkex.EffectExtension):
             # TODO: Better handle CIRCUITS_PER_DIST? Should we warn if a
             # labeled circuit also has symbols? Should we warn if
             # symbols have an unkown circuit?
-            for circuit in CIRCUITS_PER_DIST.get(dist, []):
-                if isinstance(circuit, tuple):
-                    # Add a dummy device so the given label is shown for
-                    # this circuit
-                    circuit, label = circuit
-                    circuits[str(circuit)].append(Device(label=label, space=''))
-                else:
+            for (circuit, label) in CIRCUITS_PER_DIST.get(dist, ()):
+                if label is None:
                     # Just put an empty circuit in the list, to make
                     # sure it shows up in the table
-                    circuits[str(circuit)]
+                    circuits[circuit]
+                else:
+                    # Add a dummy device so the given label is shown for
+                    # this circuit
+                    circuits[circuit].append(Device(label=label, space=''))
 
             for (circuit, symbols) in self.group_by(per_dist, 'circuit'):
                 # TODO: Option?
@@ -638,12 +966,12 @@ class ProcessElektra(inkex.EffectExtension):
             yield(dist, table)
 
     def symbols_description(self, symbols, show_fixture_connections=False, show_switches=False):
-        sockets = defaultdict(lambda: 0)
-        efixtures = defaultdict(lambda: 0)
-        fixtures = defaultdict(lambda: defaultdict(lambda: 0))
-        labels = defaultdict(lambda: defaultdict(lambda: 0))
-        fixture_connections = defaultdict(lambda: 0)
-        switches = defaultdict(lambda: 0)
+        sockets = Counter()
+        efixtures = Counter()
+        fixtures = defaultdict(Counter)
+        labels = defaultdict(Counter)
+        fixture_connections = Counter()
+        switches = Counter()
 
         for symbol in symbols:
             label = getattr(symbol, 'label', None)
@@ -656,7 +984,7 @@ class ProcessElektra(inkex.EffectExtension):
                     # all have their outlet listed, ignore the outlets
                     # for now.
                     # TODO: Do this based on wiring
-                    print(f'Ignoring Airco outlet, assuming device is listed: {symbol}')
+                    logging.debug('Ignoring Airco outlet, assuming device is listed: %s', symbol)
                     continue
                 labels[label][space] += 1
             elif isinstance(symbol, DistributionCabinet):
@@ -664,47 +992,47 @@ class ProcessElektra(inkex.EffectExtension):
             elif isinstance(symbol, Outlet):
                 if hasattr(symbol, 'switch_group'):
                     # TODO: Do this based on wiring
-                    print(f'Ignoring switchable outlet, assuming connected fixture is listed: {symbol}')
+                    logging.debug('Ignoring switchable outlet, assuming connected fixture is listed: %s', symbol)
                     continue
                 sockets[space] += symbol.sockets
             elif isinstance(symbol, EmergencyFixture):
                 efixtures[space] += 1
             elif isinstance(symbol, Fixture):
-                fixtures[space][symbol.fixture.power] += symbol.fixture.count
+                fixtures[space][symbol.power] += symbol.count
             elif isinstance(symbol, FixtureConnection):
                 fixture_connections[space] += 1
             elif isinstance(symbol, Switch):
                 switches[space] += 1
             elif isinstance(symbol, Device):
-                print(f'Device without label: {symbol}')
+                logging.warning('Device without label: %s', symbol)
             elif isinstance(symbol, Connection):
-                print(f'Connection without label: {symbol}')
+                logging.warning('Connection without label: %s', symbol)
             else:
-                print(f'Unknown symbol for circuits list: {symbol}')
+                logging.warning('Unknown symbol for circuits list: %s', symbol)
 
         description = []
         if switches and show_switches:
             description.append('Schakelaars: {}'.format(', '.join(
                 f'{space} ({count}×)' if count > 1 else f'{space}'
-                for space, count in natsort.natsorted(switches.items()))
+                for space, count in natsorted_items(switches))
             ))
 
         if fixture_connections and show_fixture_connections:
             description.append('Lichtpunten: {}'.format(', '.join(
                 f'{space} ({count}×)'
-                for space, count in natsort.natsorted(fixture_connections.items()))
+                for space, count in natsorted_items(fixture_connections))
             ))
 
         if sockets:
             # TODO: 3-phase separately?
             description.append('WCD\'s: {}'.format(', '.join(
                 f'{space} ({count}×)'
-                for space, count in natsort.natsorted(sockets.items()))
+                for space, count in natsorted_items(sockets))
             ))
         if efixtures:
             description.append('NV: {}'.format(', '.join(
                 f'{space} ({count}×)' if count > 1 else f'{space}'
-                for space, count in natsort.natsorted(efixtures.items()))
+                for space, count in natsorted_items(efixtures))
             ))
         if fixtures:
             #description.append('Verlichting: {}, Totaal {}W'.format(
@@ -713,7 +1041,7 @@ class ProcessElektra(inkex.EffectExtension):
                     space,
                     ', '.join(
                         f'{count}×{power}W' if power else f'{count}×'
-                        for power, count in natsort.natsorted(powers.items())
+                        for power, count in natsorted_items(powers)
                     )
                 ) for space, powers in sorted(fixtures.items())),
                 #sum(power * count for powers in fixtures.values() for power, count in powers.items())
@@ -723,7 +1051,7 @@ class ProcessElektra(inkex.EffectExtension):
                 label,
                 ', '.join(
                     f'{space} ({count}×)' if count > 1 else f'{space}'
-                    for space, count in natsort.natsorted(spaces.items())
+                    for space, count in natsorted_items(spaces)
                 )
             ) if spaces != {'': 1} else label for label, spaces in sorted(labels.items()))
 
@@ -769,17 +1097,18 @@ class ProcessElektra(inkex.EffectExtension):
 
     def process_layer(self, layer, **kwargs):
         for obj in layer:
-            if not isinstance(obj, inkex.elements.Layer):
+            if not isinstance(obj, Layer):
                 self.process_obj(obj, obj, **kwargs)
 
     def process_obj(self, top, obj, **kwargs):
-        if obj.attrib.get('class', None) in ['elektra-ignore', 'elektra-notitie']:
+        obj_class = obj.attrib.get('class', None)
+        if obj_class in ['elektra-ignore', 'elektra-notitie']:
             pass
-        elif obj.attrib.get('class', None) == 'elektra-kastgebied':
+        elif obj_class == 'elektra-kastgebied':
             if kwargs['sublayer'] is not None:
                 self.errors.warn(obj, "Dist contour should be in root layer for dist")
             self.dist_contours.add_contour(kwargs['floor'], obj, dist=kwargs['dist'])
-        elif isinstance(obj, inkex.elements.Use):
+        elif isinstance(obj, Use):
             # This uses xlink:href rather than the href python
             # attribute, since the latter does a lookup for the cloned
             # object, which we usually do not need.
@@ -787,12 +1116,12 @@ class ProcessElektra(inkex.EffectExtension):
 
             # Determine the space and dist contour as late as possible,
             # but only one and always before traversing a clone or
-            # processing a symbol
-            if 'space' not in kwargs:
-                space = self.space_numbers.find_space(kwargs['floor'], obj)
-                if space is None:
-                    self.errors.warn(obj, "Not inside any space", sym_attrs=kwargs)
-                kwargs['space'] = space
+            # processing a symbol. The space lookup itself is deferred
+            # until all layers are processed, so it can be done in bulk
+            # (see resolve_spaces).
+            if 'space' not in kwargs and 'space_obj' not in kwargs:
+                kwargs['space_obj'] = obj
+                self.pending_spaces[kwargs['floor']].append((obj, kwargs))
 
             if 'contour_dist' not in kwargs:
                 contour = self.dist_contours.find_contour(kwargs['floor'], obj)
@@ -803,11 +1132,12 @@ class ProcessElektra(inkex.EffectExtension):
                     # position from being used
                     kwargs['contour_dist'] = None
 
-            info = SYMBOLS.get(href, None)
-            if info:
+            factory = SYMBOL_FACTORIES.get(href, None)
+            if factory:
                 # Found an actual symbol, process it with all the info
                 # we collected
-                self.process_symbol(info, top, obj, **kwargs)
+                (cls, attrs) = factory
+                self.process_symbol(cls, attrs, top, obj, **kwargs)
             else:
                 # This must be a clone of a symbol with labels and all
                 original = obj.href
@@ -821,30 +1151,27 @@ class ProcessElektra(inkex.EffectExtension):
                 else:
                     self.process_obj(top, original, **kwargs)
 
-        elif isinstance(obj, inkex.elements.Group):
+        elif isinstance(obj, Group):
             later = []
             for part in obj:
                 cls = part.attrib.get('class', None)
                 text = None
-                if isinstance(part, inkex.elements.TextElement):
+                if isinstance(part, TextElement):
                     text = part.get_text()
 
-                class_to_attr = {
-                    'elektra-groep': 'circuit',
-                    'elektra-schakelaar': 'switch_group',
-                    'elektra-armatuur': 'fixture_id',
-                    'elektra-kast': 'distbox_label',
-                    'elektra-label': 'label',
-                    'elektra-ruimte': 'space',
-                }
-
-                attr = class_to_attr.get(cls, None)
+                attr = CLASS_TO_ATTR.get(cls, None)
 
                 if self.options.mark_questions and text and '?' in text:
                     self.errors.warn(part, "Question")
 
                 # TODO: Check swatch based on class?
                 if text and attr:
+                    if attr == 'space' and 'space_obj' in kwargs:
+                        # An explicit space replaces the deferred lookup
+                        # (see resolve_spaces). Look it up right away
+                        # anyway, to report it as a duplicate.
+                        space_obj = kwargs.pop('space_obj')
+                        kwargs['space'] = self.space_numbers.find_space(kwargs['floor'], space_obj)
                     if attr in kwargs:
                         self.errors.warn(
                             part, "Duplicate attribute {} ('{}' and '{}')".format(cls, kwargs[attr], text)
@@ -858,7 +1185,7 @@ class ProcessElektra(inkex.EffectExtension):
 
         else:
             text = None
-            if isinstance(obj, inkex.elements.TextElement):
+            if isinstance(obj, TextElement):
                 text = obj.get_text()
 
             if text and '?' in text:
@@ -872,12 +1199,12 @@ class ProcessElektra(inkex.EffectExtension):
             else:
                 # Lookup space for the error message
                 if 'space' not in kwargs:
-                    kwargs['space'] = self.space_numbers.find_space(kwargs['floor'], obj)
+                    space_obj = kwargs.get('space_obj', obj)
+                    kwargs['space'] = self.space_numbers.find_space(kwargs['floor'], space_obj)
                 self.errors.warn(obj, "Unknown object", sym_attrs=kwargs)
 
-    def process_symbol(self, info, top, obj, **kwargs):
-        kwargs.update(**info)
-        cls = kwargs.pop('class')
+    def process_symbol(self, cls, attrs, top, obj, **kwargs):
+        kwargs.update(attrs)
 
         # TODO: Move to separate check function?
         if kwargs['sublayer'] not in cls.sublayers:
@@ -886,15 +1213,7 @@ class ProcessElektra(inkex.EffectExtension):
 
         circuit = kwargs.get('circuit', None)
         if circuit:
-            # This regex ended up a bit complex, but needed to support
-            # both dot-separated like L01.2 or also L01.K2, but also
-            # unseparated like NV1, and I wanted to have only two
-            # capture groups for dist and circuit. I'm not sure I
-            # understand it exactly, but it works for all cases needed:
-            #   c = ['L1.2', 'L1.23', 'L01.2', 'L01.23', 'HKL.2', 'HKL.23', 'HKL.K2',
-            #       'NV1', 'NV?', '?', '2', '23', 'NC'])]
-            #   [re.match(r'([A-Z]+|.*(?=\.)|)\.?((?<=\.).*|[0-9?+]+|(?<=^).*)$', s).groups() for s in c]
-            m = re.match(r'([A-Z]+|.*(?=\.)|)\.?((?<=\.).*|[0-9?+]+|(?<=^).*)$', circuit)
+            m = CIRCUIT_RE.match(circuit)
             label_dist, new_circuit = m.groups()
 
             contour_dist = kwargs.get('contour_dist', None)
@@ -921,23 +1240,33 @@ class ProcessElektra(inkex.EffectExtension):
             fixture_id = 'Z'
 
         if fixture_id:
-            try:
-                kwargs['fixture'] = FIXTURES[fixture_id]
-            except KeyError:
+            fixture = FIXTURES.get(fixture_id, None)
+            if fixture is None:
                 self.errors.warn(obj, f'Unknown fixture type: {fixture_id}', sym_attrs=kwargs)
+            else:
+                kwargs['fixture'] = fixture
+                # Copied onto the symbol for quick access when
+                # summarizing circuits
+                kwargs['power'] = fixture.power
+                kwargs['count'] = fixture.count
 
         kwargs['obj'] = obj
 
         # If multiple switch groups are specified (e.g. a+b), just
         # generate multiple symbols for simplicity
-        for switch_group in kwargs.get('switch_group', '').split('+'):
-            if switch_group:
-                if switch_group in LOCAL_SWITCHES:
-                    kwargs['global_switch_group'] = '{}-{}'.format(kwargs['space'], switch_group)
-                else:
-                    kwargs['global_switch_group'] = switch_group
+        switch_groups = kwargs.get('switch_group', '')
+        if '+' not in switch_groups:
+            self.add_symbol(cls, kwargs, switch_groups)
+        else:
+            for switch_group in switch_groups.split('+'):
+                self.add_symbol(cls, kwargs, switch_group)
+
+    def add_symbol(self, cls, kwargs, switch_group):
+        if switch_group:
+            # Local switch groups are made global in resolve_spaces
+            kwargs['global_switch_group'] = switch_group
 
-            self.symbols.append(cls(**kwargs))
+        self.symbols.append(cls(**kwargs))
 
 
 if __name__ == "__main__":
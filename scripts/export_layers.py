@@ -30,16 +30,26 @@
 # pages of different output files, based on configuration.
 
 import argparse
-import copy
+import contextlib
 import datetime
+import lxml.etree
+import os
 import pathlib
+import re
 import subprocess
 import sys
 import tempfile
+from collections import defaultdict
 
 sys.path.append('/usr/share/inkscape/extensions')
 import inkex
 
+try:
+    import pypdf
+except ImportError:
+    # Fall back to running pdftk
+    pypdf = None
+
 
 # Add a Mask object, which seems to be missing from inkex. It's just a simple
 # container like ClipPath
@@ -48,6 +58,96 @@ class Mask(inkex.elements._groups.GroupBase):
     tag_name = 'mask'
 
 
+INKSCAPE_LABEL = '{http://www.inkscape.org/namespaces/inkscape}label'
+LAYER_XPATH = lxml.etree.XPath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS)
+# Text spans whose parent has an id, for filling in texts by id
+ID_TSPAN_XPATH = lxml.etree.XPath('//*[@id]/svg:tspan', namespaces=inkex.NSS)
+# Attributes that can refer to other objects by id
+REFERENCE_XPATH = lxml.etree.XPath('//@xlink:href | //@href | //@*[contains(., "url(#")]', namespaces=inkex.NSS)
+URL_REFERENCE_RE = re.compile(r'url\(#([^)]*)\)')
+ID_XPATH = lxml.etree.XPath('//*[@id]')
+
+
+class UndoLog:
+    """
+    Records how to revert changes to the document, so the same document
+    can be modified for each page and restored afterwards, rather than
+    copying the entire document for every page. Changes are reverted in
+    reverse order when the with block ends.
+    """
+    def __init__(self):
+        self.actions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        while self.actions:
+            self.actions.pop()()
+
+    def on_undo(self, func, *args):
+        self.actions.append(lambda: func(*args))
+
+    def save_attrib(self, elem, *names):
+        for name in names:
+            value = elem.attrib.get(name, None)
+            if value is None:
+                self.on_undo(elem.attrib.pop, name, None)
+            else:
+                self.on_undo(elem.attrib.__setitem__, name, value)
+
+    def save_text(self, elem):
+        self.on_undo(setattr, elem, 'text', elem.text)
+
+    def added(self, elem):
+        self.on_undo(elem.getparent().remove, elem)
+
+    def remove(self, elem):
+        parent = elem.getparent()
+        self.on_undo(parent.insert, parent.index(elem), elem)
+        parent.remove(elem)
+
+
+class InkscapeShell:
+    """
+    An inkscape process running in shell mode, which renders SVG files
+    to PDF as they are queued, so inkscape only has to start once for
+    many pages. Call close() to wait for all queued files to be rendered
+    (and to check that they were).
+    """
+    def __init__(self):
+        # Only the prompts go to stdout, errors are shown on stderr
+        self.process = subprocess.Popen(['inkscape', '--shell'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL, text=True)
+        self.queued = []
+
+    def export_to_pdf(self, svg_path, output_path):
+        # Actions are separated by ; and there is no way to escape it
+        for path in (svg_path, output_path):
+            if ';' in str(path):
+                raise Exception("Cannot render {} with inkscape shell, path contains ';'".format(path))
+
+        self.process.stdin.write(f'file-open:{svg_path}; export-filename:{output_path}; '
+                                 'export-area-page; export-do; file-close\n')
+        self.process.stdin.flush()
+        self.queued.append((svg_path, output_path))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        finally:
+            # Always wait, so no inkscape process is left behind
+            returncode = self.process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.process.args)
+
+        # A failed page does not stop the shell, so check that every
+        # page was actually rendered
+        for (svg_path, output_path) in self.queued:
+            if not pathlib.Path(output_path).exists():
+                raise Exception("Inkscape failed to render {} to {}".format(svg_path, output_path))
+
+
 class LayerSetExport(inkex.Effect):
     def __init__(self):
         inkex.Effect.__init__(self)
@@ -93,138 +193,241 @@ class LayerSetExport(inkex.Effect):
             svgdir = output_path / 'svg'
             svgdir.mkdir(parents=True, exist_ok=True)
 
-        for output in outputs:
-            if self.options.only and self.options.only not in output['filename']:
-                continue
-            with tempfile.TemporaryDirectory() as tempdir:
-                tempdir = pathlib.Path(tempdir)
-
-                filename = "{} {}".format(datetime.date.today().isoformat(), output['filename'])
-                path = output_path / filename
-                temp_svg = tempdir / 'page.svg'
-                temp_pdfs = []
-                print("Exporting {}".format(path))
-                for (i, page) in enumerate(output['pages']):
-                    print("  Page {}".format(i + 1))
-
-                    if self.options.keep_svgs:
-                        temp_svg = svgdir / '{}_page{}.svg'.format(filename, i + 1)
-
-                    texts = output.pop('texts', {})
-                    texts.update({
-                        'title-block-title': output.get('title', ''),
-                        'title-block-subtitle': page.get('subtitle', ''),
-                        'title-block-date': datetime.date.today().isoformat(),
-                        'title-block-sheet': '{} / {}'.format(i + 1, len(output['pages'])),
-                    })
-
-                    self.export_layers(temp_svg, page['layers'], texts, **output)
-                    temp_pdf = tempdir / 'page{}.pdf'.format(i + 1)
-                    temp_pdfs.append(temp_pdf)
-
-                    self.export_to_pdf(temp_svg, temp_pdf)
-
+        # The same (in place modified and restored) document is used
+        # for every page, so these only need to be looked up once
+        self.layers_by_label = defaultdict(lambda: [])
+        for layer in LAYER_XPATH(self.document):
+            self.layers_by_label[layer.attrib[INKSCAPE_LABEL]].append(layer)
+        self.referenced_layers = self.find_referenced_layers()
+        # The (first) span of each text with an id, to fill in texts
+        self.spans_by_id = {}
+        for span in ID_TSPAN_XPATH(self.document):
+            self.spans_by_id.setdefault(span.getparent().get('id'), span)
+        # Clip paths by object id, built once and added to each page
+        # that needs them
+        self.clip_paths = {}
+
+        # Used for all files and pages, so they all get the same date
+        today = datetime.date.today().isoformat()
+
+        # The document is modified for each page, so pages are written
+        # one by one, but rendering them with inkscape (which takes most
+        # of the time) happens in parallel, spread over a few persistent
+        # inkscape processes that are reused for all outputs. Once all
+        # pages are rendered, the pages of each output are concatenated.
+        shells = []
+        # cpu_count() returns None when it cannot tell
+        max_shells = os.cpu_count() or 1
+        page_count = 0
+        concatenations = []
+        with tempfile.TemporaryDirectory() as tempdir:
+            tempdir = pathlib.Path(tempdir)
+            # Closing a shell waits for all its pages to be rendered.
+            # Every shell is closed (and waited for), even when another
+            # one fails, and only then is the error raised.
+            with contextlib.ExitStack() as stack:
+                for (n, output) in enumerate(outputs):
+                    if self.options.only and self.options.only not in output['filename']:
+                        continue
+
+                    filename = "{} {}".format(today, output['filename'])
+                    path = output_path / filename
+                    temp_pdfs = []
+                    # Texts to fill in on every page of this output, in
+                    # addition to the title block texts set below
+                    output_texts = output.get('texts', {})
+                    print("Exporting {}".format(path))
+                    for (i, page) in enumerate(output['pages']):
+                        print("  Page {}".format(i + 1))
+
+                        # Each page needs its own SVG, since it may still
+                        # be rendered while the next page is written
+                        temp_svg = tempdir / 'output{}_page{}.svg'.format(n + 1, i + 1)
+                        if self.options.keep_svgs:
+                            temp_svg = svgdir / '{}_page{}.svg'.format(filename, i + 1)
+
+                        texts = {
+                            **output_texts,
+                            'title-block-title': output.get('title', ''),
+                            'title-block-subtitle': page.get('subtitle', ''),
+                            'title-block-date': today,
+                            'title-block-sheet': '{} / {}'.format(i + 1, len(output['pages'])),
+                        }
+
+                        self.export_layers(temp_svg, page['layers'], texts,
+                                           page_size=output.get('page_size', None),
+                                           transform_layers=output.get('transform_layers', ()))
+                        temp_pdf = tempdir / 'output{}_page{}.pdf'.format(n + 1, i + 1)
+                        temp_pdfs.append(temp_pdf)
+
+                        # Start one inkscape per CPU for the first pages,
+                        # then reuse them in turn
+                        if len(shells) < max_shells:
+                            shell = InkscapeShell()
+                            stack.callback(shell.close)
+                            shells.append(shell)
+                        shells[page_count % len(shells)].export_to_pdf(temp_svg, temp_pdf)
+                        page_count += 1
+
+                    concatenations.append((temp_pdfs, path))
+
+            for (temp_pdfs, path) in concatenations:
                 path.parent.mkdir(parents=True, exist_ok=True)
-                print(['pdftk', *temp_pdfs, 'cat', 'output', path])
-                subprocess.run(['pdftk', *temp_pdfs, 'cat', 'output', path], check=True)
+                self.concatenate_pdfs(temp_pdfs, path)
 
-    def export_layers(self, dest, show, texts, page_size=None, transform_layers=(), **kwargs):
+    def export_layers(self, dest, show, texts, page_size=None, transform_layers=()):
         """
         Export selected layers of SVG to the file `dest`.
         :arg  str   dest:  path to export SVG file.
         :arg  list  hide:  layers to hide. each element is a string.
         :arg  list  show:  layers to show. each element is a string.
         """
-        doc = copy.deepcopy(self.document)
+        doc = self.document
         svg = doc.getroot()
-        if page_size is not None:
-            svg.attrib['width'], svg.attrib['height'] = page_size
-
-        transform_dict = {
-            layer: {
-                'scale': spec.get('scale', None),
-                'scale_center': spec.get('scale_center', None),
-                'clip_obj': self.make_clip_path(svg, spec['clip']) if 'clip' in spec else None,
-                'opacity': spec.get('opacity', None),
-            } for spec in transform_layers for layer in spec['layers']
-        }
-
-        for layer in doc.xpath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS):
-            # TODO: Unhardcode inkscape NS
-            label_attr = '{http://www.inkscape.org/namespaces/inkscape}label'
-            label = layer.attrib[label_attr]
-            if label in show:
-                layer.attrib['style'] = 'display:inline'
-            else:
-                layer.attrib['style'] = 'display:none'
-
-            transform_spec = transform_dict.get(label, None)
-            if transform_spec is not None:
-                if 'transform' in layer.attrib:
-                    raise Exception("Layer {} already has transform, cannot scale".format(label))
-
-                scale = transform_spec['scale']
-                if scale:
-                    (cx, cy) = transform_spec['scale_center']
-
-                    layer.transform.add_scale(scale)
-
-                    # This effectively moves the layer so (cx, cy) is at the
-                    # origin, then scales, then moves back so (cx, cy) ends
-                    # up in its original position
-                    layer.transform.add_translate(-cx + cx / scale, -cy + cy / scale)
-
-                clip_obj = transform_spec['clip_obj']
-                if clip_obj is not None:
-                    self.wrap(layer, wrapper=inkex.elements.Layer).clip = clip_obj
-
-                opacity = transform_spec['opacity']
+        with UndoLog() as undo:
+            if page_size is not None:
+                undo.save_attrib(svg, 'width', 'height')
+                svg.attrib['width'], svg.attrib['height'] = page_size
+
+            # Transform spec per layer label, later specs win
+            transform_dict = {layer: spec for spec in transform_layers for layer in spec['layers']}
+
+            layers_by_label = self.layers_by_label
+            show = frozenset(show)
+            # Each layer gets its complete style (visibility and any
+            # opacity from its transform spec) in a single write
+            for (label, layers) in layers_by_label.items():
+                style = 'display:inline' if label in show else 'display:none'
+                opacity = transform_dict.get(label, {}).get('opacity', None)
                 if opacity is not None:
-                    layer.attrib['style'] += ';opacity:{}'.format(opacity)
+                    style += ';opacity:{}'.format(opacity)
+                for layer in layers:
+                    undo.save_attrib(layer, 'style')
+                    layer.attrib['style'] = style
+
+            for (label, transform_spec) in transform_dict.items():
+                # Hidden layers are not rendered (and mostly removed
+                # below), so there is no point in transforming them
+                if label not in show:
+                    continue
+
+                # Only created when a layer to clip actually exists
+                clip_obj = None
+                for layer in layers_by_label.get(label, ()):
+                    if 'transform' in layer.attrib:
+                        raise Exception("Layer {} already has transform, cannot scale".format(label))
+
+                    scale = transform_spec.get('scale', None)
+                    if scale:
+                        (cx, cy) = transform_spec['scale_center']
+
+                        undo.save_attrib(layer, 'transform')
+
+                        # This effectively moves the layer so (cx, cy) is at the
+                        # origin, then scales, then moves back so (cx, cy) ends
+                        # up in its original position. The layer has no
+                        # transform yet, so the scale and translate can be
+                        # combined into a single matrix directly.
+                        (tx, ty) = (-cx + cx / scale, -cy + cy / scale)
+                        layer.attrib['transform'] = 'matrix({0},0,0,{0},{1},{2})'.format(scale, tx * scale, ty * scale)
+
+                    if clip_obj is None and 'clip' in transform_spec:
+                        clip_obj = self.make_clip_path(svg, transform_spec['clip'], undo)
+                    if clip_obj is not None:
+                        # A clip path is applied in the coordinates of the
+                        # element it is set on, so a scaled layer is
+                        # wrapped to clip it in page coordinates. A layer
+                        # with its own clip is wrapped too, to keep both.
+                        # Otherwise the layer can just be clipped directly.
+                        if scale or 'clip-path' in layer.attrib:
+                            target = self.wrap(layer, wrapper=inkex.elements.Layer)
+                            undo.on_undo(self.unwrap, target)
+                        else:
+                            target = layer
+                            undo.save_attrib(layer, 'clip-path')
+                        target.clip = clip_obj
+
+            # Remove hidden layers from the page entirely, so inkscape
+            # does not have to parse them. Layers that contain objects
+            # referenced from elsewhere (e.g. by clones) are kept hidden.
+            for (label, layers) in layers_by_label.items():
+                if label not in show:
+                    for layer in layers:
+                        if layer not in self.referenced_layers:
+                            undo.remove(layer)
 
             # Use masking to fade out everything outside of the working
             # area of a circuit box.
             # TODO: Implement/generalize this once inkscape is fixed: https://gitlab.com/inkscape/inkscape/-/issues/694
-            if False and label == 'V0_basistekening':
-                # TODO: Rather than hardcoding 0.5 mask for everything
-                # else, put a nice gradient that fades out the rest of
-                # the building in the mask object?
-                kast_mask = self.make_mask(svg, 'mask-elektra-l02-area', 1, 0.5)
-                self.apply_mask(layer, kast_mask)
-
-        # TODO: Update metadata data & title?
-        for (idattr, value) in texts.items():
-            span = svg.getElement('//*[@id="{}"]/svg:tspan'.format(idattr))
-            if span is not None:
-                span.text = value
-
-        doc.write(dest)
-
-    def make_clip_path(self, svg, obj_id):
-        obj = svg.getElementById(obj_id)
-        if obj is None:
-            return None
+            if False:
+                for layer in layers_by_label.get('V0_basistekening', ()):
+                    # TODO: Rather than hardcoding 0.5 mask for everything
+                    # else, put a nice gradient that fades out the rest of
+                    # the building in the mask object?
+                    kast_mask = self.make_mask(svg, 'mask-elektra-l02-area', undo, 1, 0.5)
+                    undo.save_attrib(layer, 'mask')
+                    self.apply_mask(layer, kast_mask)
+
+            # TODO: Update metadata data & title?
+            for (idattr, text) in texts.items():
+                span = self.spans_by_id.get(idattr, None)
+                if span is not None:
+                    undo.save_text(span)
+                    span.text = text
+
+            # Write UTF-8 rather than lxml's default of ASCII, which
+            # escapes every non-ASCII character as a numeric entity
+            doc.write(dest, encoding='utf-8', xml_declaration=True)
+
+    def find_referenced_layers(self):
+        """
+        Return all layers that are, or contain (at any depth), an object
+        that is referenced by id from an href or url(#...) attribute.
+        """
+        ids = set()
+        for value in REFERENCE_XPATH(self.document):
+            if value.startswith('#'):
+                ids.add(value[1:])
+            else:
+                ids.update(URL_REFERENCE_RE.findall(value))
 
-        clip = inkex.elements.ClipPath()
-        clip.append(obj.copy())
-        svg.append(clip)
+        layers = set()
+        for obj in ID_XPATH(self.document):
+            if obj.get('id') in ids:
+                # A layer can also be cloned itself
+                layers.update(elem for elem in (obj, *obj.iterancestors())
+                              if isinstance(elem, inkex.elements.Layer))
+        return layers
+
+    def make_clip_path(self, svg, obj_id, undo):
+        try:
+            clip = self.clip_paths[obj_id]
+        except KeyError:
+            obj = svg.getElementById(obj_id)
+            clip = None if obj is None else inkex.elements.ClipPath(obj.copy())
+            self.clip_paths[obj_id] = clip
+        # Several transform specs on the same page can share a clip,
+        # which should only be added (and removed) once
+        if clip is not None and clip.getparent() is None:
+            svg.append(clip)
+            undo.added(clip)
         return clip
 
-    def make_mask(self, svg, obj_id, opacity, outside_opacity=None):
+    def make_mask(self, svg, obj_id, undo, opacity, outside_opacity=None):
         obj = svg.getElementById(obj_id)
         mask = Mask()
         if outside_opacity:
             (x, y, w, h) = svg.get_viewbox()
             page_rect = inkex.elements.Rectangle.new(left=x, top=y, width=w, height=h)
-            page_rect.style['fill'] = '#ffffff'
-            page_rect.style['fill-opacity'] = str(outside_opacity)
+            # A new rect has no style yet, so no need to parse one
+            page_rect.attrib['style'] = 'fill:#ffffff;fill-opacity:{}'.format(outside_opacity)
             mask.append(page_rect)
 
         copy = obj.copy()
-        copy.style['fill'] = '#ffffff'
-        copy.style['fill-opacity'] = str(opacity)
+        copy.style.update({'fill': '#ffffff', 'fill-opacity': str(opacity)})
         mask.append(copy)
         svg.append(mask)
+        undo.added(mask)
         return mask
 
     def apply_mask(self, obj, mask):
@@ -238,15 +441,21 @@ class LayerSetExport(inkex.Effect):
         wrap.append(obj)
         return wrap
 
-    def export_to_pdf(self, svg_path, output_path):
-        # TODO: Replace with inkex.command.inkscape or inkscape_command?
-        area_param = '-C'
-        command = "inkscape %s -o \"%s\" \"%s\"" % (area_param, output_path, svg_path)
-
-        PIPE = subprocess.PIPE
-        with subprocess.Popen(command.encode("utf-8"), shell=True, stdout=PIPE, stderr=PIPE) as p:
-            p.wait()
-            p.kill()
+    def unwrap(self, wrap):
+        for obj in list(wrap):
+            wrap.addprevious(obj)
+        wrap.getparent().remove(wrap)
+
+    def concatenate_pdfs(self, pdf_paths, output_path):
+        if pypdf is None:
+            print(['pdftk', *pdf_paths, 'cat', 'output', output_path])
+            subprocess.run(['pdftk', *pdf_paths, 'cat', 'output', output_path], check=True)
+            return
+
+        writer = pypdf.PdfWriter()
+        for pdf_path in pdf_paths:
+            writer.append(pdf_path)
+        writer.write(output_path)
 
 
 def _main():
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import lxml.etree
 import sys
 import re
 
@@ -8,6 +9,19 @@ import inkex
 
 label_attr = '{http://www.inkscape.org/namespaces/inkscape}label'
 
+TEXT_XPATH = lxml.etree.XPath('//svg:text', namespaces=inkex.NSS)
+GRADIENT_XPATH = lxml.etree.XPath('//svg:linearGradient', namespaces=inkex.NSS)
+TSPAN_XPATH = lxml.etree.XPath('svg:tspan', namespaces=inkex.NSS)
+# Dist prefix of a circuit label (e.g. L01. in L01.2)
+DIST_PREFIX_RE = re.compile(r'L.*\.')
+
+# Class to assign, by the swatch that the fill gradient of a text refers to
+SWATCH_CLASSES = {
+    '#Elektra_groep_no': 'elektra-groep',
+    '#Elektra_schakelaar_groep': 'elektra-schakelaar',
+    '#Elektra_armatuur': 'elektra-armatuur',
+}
+
 # This is a manual one-off helper script to identify different types of
 # text based on the fill swatch they use, and then assigns a class to
 # them to make it easier to do styling and scripting on them later.
@@ -15,25 +29,30 @@ label_attr = '{http://www.inkscape.org/namespaces/inkscape}label'
 
 class Effect(inkex.Effect):
     def effect(self):
-        for t in self.svg.xpath('//svg:text'):
-            m = re.match(r'^url\(#(.*)\)', t.style['fill'])
-            if m:
-                gradient = self.svg.getElement('//svg:linearGradient[@id="{}"]'.format(m.group(1)))
-                try:
-                    swatch = gradient.attrib['{http://www.w3.org/1999/xlink}href']
-
-                    if swatch == '#Elektra_groep_no':
-                        t.attrib['class'] = 'elektra-groep'
-                        # While we're here, do a quick text replacement
-                        # as well.
-                        for span in t.xpath('svg:tspan'):
-                            span.text = re.sub(r'L.*\.', '', span.text)
-                    if swatch == '#Elektra_schakelaar_groep':
-                        t.attrib['class'] = 'elektra-schakelaar'
-                    if swatch == '#Elektra_armatuur':
-                        t.attrib['class'] = 'elektra-armatuur'
-                except KeyError:
+        # Swatch (or None) by gradient id, so the gradients do not have
+        # to be looked up for every text
+        swatches = {
+            gradient.get('id'): gradient.get('{http://www.w3.org/1999/xlink}href', None)
+            for gradient in GRADIENT_XPATH(self.svg)
+        }
+
+        for t in TEXT_XPATH(self.svg):
+            fill = t.style.get('fill', '')
+            if fill.startswith('url(#') and fill.endswith(')'):
+                swatch = swatches.get(fill[5:-1], None)
+                if swatch is None:
                     print("Ignoring " + t.get_text())
+                    continue
+
+                cls = SWATCH_CLASSES.get(swatch, None)
+                if cls is not None:
+                    t.attrib['class'] = cls
+
+                if cls == 'elektra-groep':
+                    # While we're here, do a quick text replacement
+                    # as well.
+                    for span in TSPAN_XPATH(t):
+                        span.text = DIST_PREFIX_RE.sub('', span.text)
 
         self.document.write('output.svg')
 
@@ -25,6 +25,7 @@
 
 import copy
 import datetime
+import lxml.etree
 import os
 import subprocess
 import sys
@@ -35,6 +36,10 @@ import inkex
 
 label_attr = '{http://www.inkscape.org/namespaces/inkscape}label'
 
+LABELED_GROUP_XPATH = lxml.etree.XPath('//svg:g[@inkscape:label]', namespaces=inkex.NSS)
+TEXT_XPATH = lxml.etree.XPath('.//svg:text', namespaces=inkex.NSS)
+TSPAN_XPATH = lxml.etree.XPath('svg:tspan', namespaces=inkex.NSS)
+
 # This is a manual one-off helper script that does some processing of
 # text 
 # elements with another. This updates the elements themselves, and
@@ -43,12 +48,20 @@ label_attr = '{http://www.inkscape.org/namespaces/inkscape}label'
 
 class Effect(inkex.Effect):
     def effect(self):
+        # Find all labeled groups once, both to find the layers to
+        # process and the layers to copy into (the first one with a
+        # given label wins)
+        groups = LABELED_GROUP_XPATH(self.svg)
+        groups_by_label = {}
+        for group in groups:
+            groups_by_label.setdefault(group.attrib[label_attr], group)
+
         # Only process text in this particular label
-        for layer in self.svg.xpath('//svg:g[contains(@inkscape:label, "bestemming")]', namespaces=inkex.NSS):
+        for layer in (g for g in groups if "bestemming" in g.attrib[label_attr]):
             print("Layer", layer.attrib[label_attr])
             copylayerlabel = layer.attrib[label_attr].replace("bestemming", "oppervlaktes")
-            copylayer = self.svg.findone('//svg:g[@inkscape:label="{}"]'.format(copylayerlabel))
-            for text in layer.xpath('.//svg:text'):
+            copylayer = groups_by_label.get(copylayerlabel, None)
+            for text in TEXT_XPATH(layer):
                 # Delete text nodes without any children
                 if not any(True for _ in text):
                     print("Deleting empty text", text.attrib['id'])
@@ -56,10 +69,10 @@ class Effect(inkex.Effect):
                     continue
 
                 # Flatten nested tspans
-                spans = text.xpath('svg:tspan')
-                if len(spans) == 1 and len(spans[0].xpath('svg:tspan')) > 0:
+                spans = TSPAN_XPATH(text)
+                if len(spans) == 1 and len(TSPAN_XPATH(spans[0])) > 0:
                     print("Flattening nested text", text.attrib['id'])
-                    for subspan in spans[0].xpath('svg:tspan'):
+                    for subspan in TSPAN_XPATH(spans[0]):
                         text.append(subspan)
                         spans[0].delete()
 
@@ -70,7 +83,7 @@ class Effect(inkex.Effect):
                 # below the original text.
                 copytext = text.copy()
                 copylayer.append(copytext)
-                for i, span in enumerate(copytext.xpath('svg:tspan')):
+                for i, span in enumerate(TSPAN_XPATH(copytext)):
                     if i == 0:
                         span.text = 'm²'
                     else:
@@ -78,7 +91,7 @@ class Effect(inkex.Effect):
 
                 OFFSET = 30
                 text.attrib['y'] = str(float(text.attrib['y']) + OFFSET)
-                for span in text.xpath('svg:tspan'):
+                for span in TSPAN_XPATH(text):
                     span.attrib['y'] = str(float(span.attrib['y']) + OFFSET)
 
         self.document.write('output.svg')
@@ -2,6 +2,7 @@
 
 import sys
 import collections
+import lxml.etree
 
 sys.path.append('/usr/share/inkscape/extensions')
 import inkex
@@ -49,20 +50,27 @@ IDS = {
 
 class Effect(inkex.EffectExtension):
     def effect(self):
+        # Update ids and clones in a single walk over the document
         clones_updated = collections.defaultdict(lambda: 0)
+        updated_ids = set()
+        for obj in self.svg.iter(tag=lxml.etree.Element):
+            old_id = obj.get('id')
+            # Like getElementById, only update the first element with an id
+            if old_id in IDS and old_id not in updated_ids:
+                obj.set('id', IDS[old_id])
+                updated_ids.add(old_id)
+
+            if isinstance(obj, inkex.Use):
+                href = obj.get('xlink:href').strip('#')
+                new_href = IDS.get(href, None)
+                if new_href:
+                    obj.set('xlink:href', '#' + new_href)
+                    clones_updated["{}->{}".format(href, new_href)] += 1
+
         for old_id, new_id in IDS.items():
-            obj = self.svg.getElementById(old_id)
-            if obj is not None:
-                obj.set('id', new_id)
+            if old_id in updated_ids:
                 print("{}->{}: Updated id".format(old_id, new_id))
 
-        for clone in self.svg.xpath('//svg:use'):
-            href = clone.get('xlink:href').strip('#')
-            new_href = IDS.get(href, None)
-            if new_href:
-                clone.set('xlink:href', '#' + new_href)
-                clones_updated["{}->{}".format(href, new_href)] += 1
-
         for ids, count in clones_updated.items():
             print("{}: Updated {} clones".format(ids, count))
 